@@ -0,0 +1,69 @@
+import os
+import subprocess
+import sys
+import zlib
+
+# import にかかる時間を別プロセスで計測し、上限を超えたり
+# 不要な numpy / numba を読み込んだりしたら失敗する
+# 使い方: python benchmark_import.py [繰り返し回数]
+SMALL_RECORD = b" ".join(
+    b'{"id": %d, "level": "info", "path": "/api/v1/items", "status": 200}' % i
+    for i in range(6))
+# import 直後に小さなレコードを伸長する。短命なプロセス向けに純 Python 版へ固定したとき
+# numpy も numba も読み込まれないことを確かめる
+INFLATE_SMALL_RECORD = "assert codeckit.deflate_index.build_index({!r}).seek_read(0, {}) == {!r}".format(
+    zlib.compress(SMALL_RECORD), len(SMALL_RECORD), SMALL_RECORD)
+
+TARGETS = [
+    # (import するモジュール, 上限(ミリ秒), 読み込まれてはいけないモジュール, import 後に実行する処理)
+    ("codeckit", 30, ["numpy", "numba"], None),
+    ("codeckit.deflate", 50, ["numpy", "numba"], None),
+    ("codeckit.deflate_index", 50, ["numpy", "numba"], None),
+    ("codeckit.deflate_index", 80, ["numpy", "numba"],
+        ("inflate", INFLATE_SMALL_RECORD, {"CODECKIT_KERNEL_BACKEND": "python"})),
+    ("codeckit.blocksort", 30, ["numpy", "numba"], None),
+    ("codeckit.huffman", 400, ["numba"], None),
+    ("codeckit.fse", 400, ["numba"], None),
+]
+
+__MEASURE_CODE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+{statement}
+elapsed = time.perf_counter() - start
+print(elapsed * 1000, ",".join(m for m in {forbidden!r} if m in sys.modules))
+"""
+
+def measure(module, forbidden, statement="", backend_env=None):
+    # 毎回新しいインタプリタで計測する(起動自体の時間は含めない)
+    # バックエンドの指定は外し、対象ごとに指定したものだけを渡す
+    code = __MEASURE_CODE.format(module=module, statement=statement, forbidden=forbidden)
+    env = dict(os.environ)
+    env.pop("CODECKIT_KERNEL_BACKEND", None)
+    env.update(backend_env or {})
+    output = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True, env=env,
+        cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+    return float(output[0]), (output[1].split(",") if 1 < len(output) else [])
+
+def main(repeat):
+    failed = False
+    for module, limit_ms, forbidden, run in TARGETS:
+        label, statement, backend_env = run if run else ("", "", None)
+        results = [measure(module, forbidden, statement, backend_env) for _ in range(repeat)]
+        best_ms = min(elapsed for elapsed, _ in results)
+        loaded = sorted(set(m for _, modules in results for m in modules))
+        status = "ok"
+        if limit_ms < best_ms:
+            status = "SLOW"
+        if loaded:
+            status = "LOADED " + ",".join(loaded)
+        failed = failed or status != "ok"
+        name = module + " + " + label if label else module
+        print("{:32s} {:8.1f} ms (limit {:4d} ms) {}".format(name, best_ms, limit_ms, status))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    repeat = int(sys.argv[1]) if 1 < len(sys.argv) else 5
+    exit(main(repeat))
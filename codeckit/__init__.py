@@ -1 +1,20 @@
-from .bitstreamer import *
+import importlib
+
+# サブモジュールは最初に参照されたときに import する(PEP 562)
+# 例えば deflate だけを使う場合は numpy を読み込まずに済む
+__SUBMODULES = {
+    "bitstreamer", "blocksort", "deflate", "deflate_index",
+    "entropy", "fse", "huffman", "kernels"}
+__BITSTREAMER_NAMES = {"BitWriter", "BitReader"}
+
+__all__ = sorted(__SUBMODULES | __BITSTREAMER_NAMES)
+
+def __getattr__(name):
+    if name in __SUBMODULES:
+        return importlib.import_module("." + name, __name__)
+    if name in __BITSTREAMER_NAMES:
+        return getattr(importlib.import_module(".bitstreamer", __name__), name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
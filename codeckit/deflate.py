@@ -1,36 +1,34 @@
-import numpy
+from . import kernels
 
 class BitReader:
     def __init__(self, byte_array):
-        self.byte_array = byte_array
+        self.byte_array = kernels.byte_array(byte_array)
         self.byte_offset = 0
         self.tmp_byte = 0
         self.remain_bit_count = 0
 
-    def __read_bit(self, value, write_offset, bit_count):
-        if self.remain_bit_count == 0:
-            self.tmp_byte = self.byte_array[self.byte_offset]
-            self.remain_bit_count = 8
-            self.byte_offset += 1
-
-        write_bit_count = min([self.remain_bit_count, bit_count])
-        bit_mask = 2 ** write_bit_count - 1
-        byte = self.tmp_byte
-        value |= (byte & bit_mask) << write_offset
-        self.tmp_byte = byte >> write_bit_count
-        self.remain_bit_count -= write_bit_count
-        bit_count -= write_bit_count
-        write_offset += write_bit_count
-        return value, write_offset, bit_count
-
     def read(self, bit_count):
-        value = 0
-        write_offset = 0
-        need_bit_count = bit_count
-        while 0 < bit_count:
-            value, write_offset, bit_count = self.__read_bit(value, write_offset, bit_count)
+        value, self.byte_offset, self.tmp_byte, self.remain_bit_count = kernels.read_bits(
+            self.byte_array, self.byte_offset, self.tmp_byte, self.remain_bit_count, bit_count)
         return value
 
+    def decode_symbol(self, huffman_tree):
+        child0, child1, keys = huffman_tree
+        value, self.byte_offset, self.tmp_byte, self.remain_bit_count = kernels.decode_symbol(
+            self.byte_array, self.byte_offset, self.tmp_byte, self.remain_bit_count,
+            child0, child1, keys)
+        return int(value)
+
+    def tell(self):
+        return self.byte_offset * 8 - self.remain_bit_count
+
+    def seek(self, bit_offset):
+        # 途中のビットから読み始める場合は、そのバイトの残りを読み込んでおく
+        self.byte_offset = bit_offset // 8
+        self.tmp_byte = 0
+        self.remain_bit_count = 0
+        self.read(bit_offset % 8)
+
     def discard_bits_to_byte_border(self):
         self.remain_bit_count = 0
         return None
@@ -39,34 +37,35 @@ class BitReader:
         if self.remain_bit_count != 0:
             return None
         offset = self.byte_offset
-        byte_array = self.byte_array[offset:offset + num_bytes]
+        byte_array = bytes(self.byte_array[offset:offset + num_bytes])
         self.byte_offset += num_bytes
         return byte_array
 
-def __decode_noncompressed_block(bitreader):
+def __decode_noncompressed_block(bitreader, decoded_data):
     # 半端なビットを捨ててバイト境界まで読み飛ばす
     bitreader.discard_bits_to_byte_border()
     header = bitreader.read_bytes(4)
     LEN = header[1] * 256 + header[0] # 格納されているデータ長を復元
     NLEN = header[3] * 256 + header[2] # 格納されているデータ長の補数（LEN + NLEN == 65535となる）
-    decoded_data = bitreader.read_bytes(LEN)
+    decoded_data.extend(bitreader.read_bytes(LEN))
     return decoded_data
     
 def __decode_hclen_code_length_table(bitreader, HCLEN):
     # テーブルにはアルファベット順では無い並びでハフマン符号長が保存されている
-    shuffled = numpy.array([bitreader.read(3) for _ in range(HCLEN)])
+    shuffled = [bitreader.read(3) for _ in range(HCLEN)]
     index_table = [
         16, 17, 18,  0,  8,  7,  9,  6,
         10,  5, 11,  4, 12,  3, 13,  2,
         14,  1, 15]
-    code_length_array = numpy.zeros(19, dtype=int)
+    code_length_array = [0] * 19
     # アルファベット順にハフマン符号長を並び替える
     # 存在しないアルファベットは0
     # ここでのアルファベットは
     # リテラル／長さや距離を保存するハフマン符号の符号長
     # よって0〜18の値がアルファベットである
-    code_length_array[index_table[:len(shuffled)]] = shuffled
-    return list(code_length_array)
+    for index, code_length in zip(index_table, shuffled):
+        code_length_array[index] = code_length
+    return code_length_array
 
 
 def __construct_hclen_huffman_code_table(hclen_array):
@@ -77,7 +76,7 @@ def __construct_hclen_huffman_code_table(hclen_array):
     # Step2 各ビット長へ割り当て可能なビットパターン範囲の計算
     code = 0
     bl_count[0] = 0
-    lower_value = numpy.zeros(N, dtype=int)
+    lower_value = [0] * N
     for bits in range(1, N):
         code = (code + bl_count[bits - 1]) << 1
         if bl_count[bits] != 0:
@@ -97,42 +96,32 @@ def __construct_hclen_huffman_code_table(hclen_array):
     return code_table
 
 def __make_huffman_tree(code_table):
-    root = {}
-    # 辞書でハフマン木を構築
-    # キーは 0 か 1、入っているのは次のノードかアルファベット
+    # 配列でハフマン木を構築
+    # child0/child1 は子ノードの番号(無ければ-1)、keys は葉のアルファベット(葉以外は-1)
+    child0 = [-1]
+    child1 = [-1]
+    keys = [-1]
     for code_pair in code_table:
         alphabet = code_pair[0]
         code = code_pair[1]
-        node = root
-        bl = len(code)
+        node = 0
         for bit in code:
-            bit = int(bit)
-            if bit in node:
-                node = node[bit]
-            else:
-                if bl == 1:
-                    node[bit] = alphabet
-                else:
-                    new_node = {}
-                    node[bit] = new_node
-                    node = new_node
-            bl = bl - 1
-    return root
+            children = child0 if bit == "0" else child1
+            if children[node] < 0:
+                children[node] = len(keys)
+                child0.append(-1)
+                child1.append(-1)
+                keys.append(-1)
+            node = children[node]
+        keys[node] = alphabet
+    return kernels.index_array(child0), kernels.index_array(child1), kernels.index_array(keys)
 
 def __decode_huffman_encoded_value(huffman_tree, bitreader):
-    node = huffman_tree
-    while(True):
-        bit = bitreader.read(1)
-        v = node[bit]
-        if type(v) is int:
-            return v
-        else:
-            node = v
-    return None
+    return bitreader.decode_symbol(huffman_tree)
 
 def __decode_codelength_table(
         hclen_huffman_tree, bitreader, table_size):
-    cl_table = numpy.zeros(table_size, dtype=int)
+    cl_table = [0] * table_size
     cl_table_index = 0
     # RFC 1951 3.2.7 符号長テーブルのデコード
     while(cl_table_index < table_size):
@@ -157,84 +146,49 @@ def __decode_codelength_table(
                 repeat_times = bitreader.read(7) + 11
                 # 0を繰り返す
                 code = 0
-            cl_table[cl_table_index:cl_table_index+repeat_times] = code
+            repeat_times = min(repeat_times, table_size - cl_table_index)
+            cl_table[cl_table_index:cl_table_index+repeat_times] = [code] * repeat_times
             cl_table_index += repeat_times
-    return list(cl_table)
+    return cl_table
 
-def __decode_length(bitreader, literal):
-    if 257 <= literal <= 264:
-        length = literal - 257 + 3
-    elif 265 <= literal <= 268:
-        ext_bits = bitreader.read(1)
-        length = (((literal - 265) << 1) | ext_bits) + 11
-    elif 269 <= literal <= 272:
-        ext_bits = bitreader.read(2)
-        length = (((literal - 269) << 2) | ext_bits) + 19
-    elif 273 <= literal <= 276:
-        ext_bits = bitreader.read(3)
-        length = (((literal - 273) << 3) | ext_bits) + 35
-    elif 277 <= literal <= 280:
-        ext_bits = bitreader.read(4)
-        length = (((literal - 277) << 4) | ext_bits) + 67
-    elif 281 <= literal <= 284:
-        ext_bits = bitreader.read(5)
-        length = (((literal - 281) << 5) | ext_bits) + 131
-    else: # literal == 285
-        length = 258
-    return length
+# RFC 1951 3.2.5 長さ符号(257〜285)と距離符号(0〜29)ごとの基準値と拡張ビット数
+LENGTH_BASE = [
+    3, 4, 5, 6, 7, 8, 9, 10, 11, 13, 15, 17, 19, 23, 27, 31,
+    35, 43, 51, 59, 67, 83, 99, 115, 131, 163, 195, 227, 258]
+LENGTH_EXTRA_BITS = [0] * 8 + [i // 4 for i in range(4, 24)] + [0]
+DISTANCE_BASE = [
+    1, 2, 3, 4, 5, 7, 9, 13, 17, 25, 33, 49, 65, 97, 129, 193,
+    257, 385, 513, 769, 1025, 1537, 2049, 3073, 4097, 6145, 8193, 12289, 16385, 24577]
+DISTANCE_EXTRA_BITS = [0] * 4 + [i // 2 for i in range(2, 28)]
+# 出力バッファが足りなくなったときに伸ばすバイト数(ブロックの終わりで余りは切り詰める)
+OUTPUT_GROWTH = 1 << 16
 
-def __decode_distance(bitreader, distance_type):
-    if 0 <= distance_type <= 3:
-        distance = distance_type - 0 + 1
-    elif 4 <= distance_type <= 5:
-        ext_bits = bitreader.read(1)
-        distance = (((distance_type - 4) << 1) | ext_bits) + 5
-    elif 6 <= distance_type <= 7:
-        ext_bits = bitreader.read(2)
-        distance = (((distance_type - 6) << 2) | ext_bits) + 9
-    elif 8 <= distance_type <= 9:
-        ext_bits = bitreader.read(3)
-        distance = (((distance_type - 8) << 3) | ext_bits) + 17
-    elif 10 <= distance_type <= 11:
-        ext_bits = bitreader.read(4)
-        distance = (((distance_type - 10) << 4) | ext_bits) + 33
-    elif 12 <= distance_type <= 13:
-        ext_bits = bitreader.read(5)
-        distance = (((distance_type - 12) << 5) | ext_bits) + 65
-    elif 14 <= distance_type <= 15:
-        ext_bits = bitreader.read(6)
-        distance = (((distance_type - 14) << 6) | ext_bits) + 129
-    elif 16 <= distance_type <= 17:
-        ext_bits = bitreader.read(7)
-        distance = (((distance_type - 16) << 7) | ext_bits) + 257
-    elif 18 <= distance_type <= 19:
-        ext_bits = bitreader.read(8)
-        distance = (((distance_type - 18) << 8) | ext_bits) + 513
-    elif 20 <= distance_type <= 21:
-        ext_bits = bitreader.read(9)
-        distance = (((distance_type - 20) << 9) | ext_bits) + 1025
-    elif 22 <= distance_type <= 23:
-        ext_bits = bitreader.read(10)
-        distance = (((distance_type - 22) << 10) | ext_bits) + 2049
-    elif 24 <= distance_type <= 25:
-        ext_bits = bitreader.read(11)
-        distance = (((distance_type - 24) << 11) | ext_bits) + 4097
-    elif 26 <= distance_type <= 27:
-        ext_bits = bitreader.read(12)
-        distance = (((distance_type - 26) << 12) | ext_bits) + 8193
-    elif 28 <= distance_type <= 29:
-        ext_bits = bitreader.read(13)
-        distance = (((distance_type - 28) << 13) | ext_bits) + 16385
-    else: # error
-        raise "data error"
-    return distance
+# 長さ・距離の表と固定ハフマン木は初めて使うときに一度だけ構築する
+# バックエンドによって配列の型が違うのでバックエンド名をキーにする
+__code_tables = {}
+__fixed_huffman_trees = {}
 
-def __lz77_decompress_inplace(decompressed_data, backward_distance, length):
-    start_offset = len(decompressed_data) - backward_distance
-    for offset in range(start_offset, start_offset + length, 1):
-        alphabet = decompressed_data[offset]
-        decompressed_data.append(alphabet)
-    return None
+def __get_code_tables():
+    if kernels.backend not in __code_tables:
+        __code_tables[kernels.backend] = tuple(kernels.index_array(table) for table in [
+            LENGTH_BASE, LENGTH_EXTRA_BITS, DISTANCE_BASE, DISTANCE_EXTRA_BITS])
+    return __code_tables[kernels.backend]
+
+def __decode_huffman_block(bitreader, decoded_data, literal_huffman_tree, distance_huffman_tree):
+    # リテラル・長さ・距離の復号と LZ77 のコピーはブロック単位でカーネルに任せる
+    # 距離は前のブロックを参照することがあるので、出力全体に追記していく
+    out_offset = len(decoded_data)
+    is_block_end = False
+    while not is_block_end:
+        decoded_data.extend(bytes(OUTPUT_GROWTH))
+        (bitreader.byte_offset, bitreader.tmp_byte, bitreader.remain_bit_count,
+            out_offset, is_block_end) = kernels.inflate_block(
+                bitreader.byte_array, bitreader.byte_offset,
+                bitreader.tmp_byte, bitreader.remain_bit_count,
+                *literal_huffman_tree, *distance_huffman_tree, *__get_code_tables(),
+                kernels.byte_array(decoded_data), out_offset)
+    del decoded_data[out_offset:]
+    return decoded_data
 
 def __decode_dynamic_huffman_tree(bitreader):
     HLIT = bitreader.read(5) + 257
@@ -255,81 +209,52 @@ def __decode_dynamic_huffman_tree(bitreader):
     distance_huffman_tree = __make_huffman_tree(distance_huffman_code_table)
     return literal_huffman_tree, distance_huffman_tree
 
-def __decode_dynamic_huffman_block(bitreader):
+def __decode_dynamic_huffman_block(bitreader, decoded_data):
     # 各種ハフマン木を構築
     literal_huffman_tree, distance_huffman_tree = __decode_dynamic_huffman_tree(bitreader)
-
-    # データの復号
-    decoded_data = bytearray()
-    while(True):
-        literal_or_length = __decode_huffman_encoded_value(literal_huffman_tree, bitreader);
-        if 0 <= literal_or_length <= 255:
-            # literal
-            decoded_data.append(literal_or_length)
-        elif literal_or_length == 256:
-            # end
-            break
-        else: # 257 <= literal_or_length <= 285
-            # length and distance
-            length = __decode_length(bitreader, literal_or_length)
-            distance_type = __decode_huffman_encoded_value(distance_huffman_tree, bitreader);
-            distance = __decode_distance(bitreader, distance_type)
-            __lz77_decompress_inplace(decoded_data, distance, length)
-
-    return decoded_data
+    return __decode_huffman_block(
+        bitreader, decoded_data, literal_huffman_tree, distance_huffman_tree)
 
 def __make_fixed_huffman_code_length_table():
-    code_length_table = numpy.zeros(286, dtype=int)
-    code_length_table[0:144] = 8
-    code_length_table[144:256] = 9
-    code_length_table[256:280] = 7
-    code_length_table[280:288] = 8
-    return list(code_length_table)
+    return [8] * 144 + [9] * 112 + [7] * 24 + [8] * 8
 
 def __decode_fixed_huffman_tree(bitreader):
-    literal_cl_table = __make_fixed_huffman_code_length_table()
-    literal_huffman_code_table = __construct_hclen_huffman_code_table(literal_cl_table)
-    literal_huffman_tree = __make_huffman_tree(literal_huffman_code_table)
-    return literal_huffman_tree
-
-def __decode_fixed_huffman_compressed_block(bitreader):
-    literal_huffman_tree = __decode_fixed_huffman_tree(bitreader)
+    # 固定ハフマンの距離符号は5ビット固定長だが、ハフマン符号と同じくMSBから格納されているので
+    # 符号長がすべて5のハフマン木として扱う
+    if kernels.backend not in __fixed_huffman_trees:
+        literal_huffman_code_table = __construct_hclen_huffman_code_table(
+            __make_fixed_huffman_code_length_table())
+        distance_huffman_code_table = __construct_hclen_huffman_code_table([5] * 30)
+        __fixed_huffman_trees[kernels.backend] = (
+            __make_huffman_tree(literal_huffman_code_table),
+            __make_huffman_tree(distance_huffman_code_table))
+    return __fixed_huffman_trees[kernels.backend]
 
-    # データの復号
-    decoded_data = bytearray()
-    while(True):
-        literal_or_length = __decode_huffman_encoded_value(literal_huffman_tree, bitreader);
-        if 0 <= literal_or_length <= 255:
-            # literal
-            decoded_data.append(literal_or_length)
-        elif literal_or_length == 256:
-            # end
-            break
-        else: # 257 <= literal_or_length <= 285
-            # length and distance
-            length = __decode_length(bitreader, literal_or_length)
-            distance_type = bitreader.read(5);
-            distance = __decode_distance(bitreader, distance_type)
-            __lz77_decompress_inplace(decoded_data, distance, length)
+def __decode_fixed_huffman_compressed_block(bitreader, decoded_data):
+    literal_huffman_tree, distance_huffman_tree = __decode_fixed_huffman_tree(bitreader)
+    return __decode_huffman_block(
+        bitreader, decoded_data, literal_huffman_tree, distance_huffman_tree)
 
-    return decoded_data
+def decode_block(bitreader, decoded_data):
+    # ブロックを1つ復号して decoded_data に追記し、最終ブロックかどうかを返す
+    is_end_block = bool(bitreader.read(1))
+    compress_type = bitreader.read(2)
+    if compress_type == 0b01:
+        __decode_fixed_huffman_compressed_block(bitreader, decoded_data)
+    elif compress_type == 0b10:
+        __decode_dynamic_huffman_block(bitreader, decoded_data)
+    elif compress_type == 0b00:
+        __decode_noncompressed_block(bitreader, decoded_data)
+    else:
+        raise ValueError("Invalid datastream error!")
+    return is_end_block
 
 def __decode(deflated_bytearray):
     bitreader = BitReader(deflated_bytearray)
     decoded_data = bytearray()
     is_end_block = False
     while(not is_end_block):
-        is_end_block = bool(bitreader.read(1))
-        compress_type = bitreader.read(2)
-        if compress_type == 0b01:
-            decoded_block_data = __decode_fixed_huffman_compressed_block(bitreader)
-        elif compress_type == 0b10:
-            decoded_block_data = __decode_dynamic_huffman_block(bitreader)
-        elif compress_type == 0b00:
-            decoded_block_data = __decode_noncompressed_block(bitreader)
-        else:
-            raise "Invalid datastream error!"
-        decoded_data.extend(decoded_block_data)
+        is_end_block = decode_block(bitreader, decoded_data)
 
     return decoded_data
 
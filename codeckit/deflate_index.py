@@ -0,0 +1,235 @@
+import bisect
+import struct
+import zlib
+from . import deflate
+
+# zran 方式のランダムアクセス用インデックス
+# 一度だけ全体を伸長し、span バイトごとのブロック境界で
+# 圧縮側のビット位置と直前 32KB の伸長済みデータ(窓)を記録しておく
+WINDOW_SIZE = 32768
+DEFAULT_SPAN = 1 << 20
+
+INDEX_MAGIC = b"CKZI"
+INDEX_VERSION = 3
+# 圧縮データの長さと CRC-32 も記録し、別のファイルに対してインデックスを使わないようにする
+_INDEX_HEADER = struct.Struct("<4sIQQQII")
+GZIP_TRAILER_SIZE = 8
+_CHECKPOINT_HEADER = struct.Struct("<QQI")
+
+class Checkpoint:
+    def __init__(self, out_offset, bit_offset, window):
+        self.out_offset = out_offset
+        self.bit_offset = bit_offset
+        self.window = window
+
+def __skip_zero_terminated(data, offset):
+    while data[offset] != 0:
+        offset += 1
+    return offset + 1
+
+def __is_gzip(data, offset=0):
+    return offset + 1 < len(data) and data[offset] == 0x1f and data[offset + 1] == 0x8b
+
+def deflate_start_offset(data, offset=0):
+    # gzip(RFC 1952)・zlib(RFC 1950)のヘッダを読み飛ばす。どちらでもなければ生の deflate とみなす
+    # offset には gzip のメンバーの先頭を渡せる
+    if len(data) - offset < 2:
+        raise ValueError("deflate data is too short: {} bytes".format(len(data) - offset))
+    if __is_gzip(data, offset):
+        if data[offset + 2] != 8:
+            raise ValueError("unsupported gzip compression method")
+        flags = data[offset + 3]
+        offset += 10
+        if flags & 0x04: # FEXTRA
+            offset += 2 + (data[offset] | (data[offset + 1] << 8))
+        if flags & 0x08: # FNAME
+            offset = __skip_zero_terminated(data, offset)
+        if flags & 0x10: # FCOMMENT
+            offset = __skip_zero_terminated(data, offset)
+        if flags & 0x02: # FHCRC
+            offset += 2
+        return offset
+    if (data[0] & 0x0f) == 8 and ((data[0] << 8) | data[1]) % 31 == 0:
+        if data[1] & 0x20:
+            raise ValueError("zlib preset dictionary is not supported")
+        return 2
+    return 0
+
+def _start_next_member(data, bitreader):
+    # 連結された gzip(ログのローテーションや bgzip など)では、最終ブロックの後に
+    # 8バイトのトレーラーを挟んで次のメンバーが続く。続きがあればその deflate の先頭へ移る
+    if not __is_gzip(data):
+        return False
+    bitreader.discard_bits_to_byte_border()
+    offset = bitreader.tell() // 8 + GZIP_TRAILER_SIZE
+    if len(data) < offset:
+        raise ValueError("truncated gzip trailer")
+    if __is_gzip(data, offset):
+        bitreader.seek(deflate_start_offset(data, offset) * 8)
+        return True
+    # 末尾のゼロ埋めは許すが、それ以外のデータを黙って捨てることはしない
+    if any(bytes(data[offset:])):
+        raise ValueError("unexpected data after gzip member at offset {}".format(offset))
+    return False
+
+class DeflateIndex:
+    def __init__(self, data, checkpoints, span, length):
+        self.data = data
+        self.checkpoints = checkpoints
+        self.span = span
+        self.length = length
+        self.out_offsets = [checkpoint.out_offset for checkpoint in checkpoints]
+
+    def __find_checkpoint(self, offset):
+        index = bisect.bisect_right(self.out_offsets, offset) - 1
+        return self.checkpoints[max(index, 0)]
+
+    def seek_read(self, offset, length):
+        # 直前のチェックポイントから伸長を再開し、必要な範囲まで読んだら止める
+        if offset < 0 or length < 0:
+            raise ValueError("offset and length must be non-negative: {}, {}".format(offset, length))
+        end_offset = min(offset + length, self.length)
+        if end_offset <= offset:
+            return b""
+        checkpoint = self.__find_checkpoint(offset)
+        bitreader = deflate.BitReader(self.data)
+        bitreader.seek(checkpoint.bit_offset)
+        decoded_data = bytearray(checkpoint.window)
+        base_offset = checkpoint.out_offset - len(checkpoint.window)
+        while base_offset + len(decoded_data) < end_offset:
+            if deflate.decode_block(bitreader, decoded_data):
+                if not _start_next_member(self.data, bitreader):
+                    break
+        return bytes(decoded_data[offset - base_offset:end_offset - base_offset])
+
+    def save(self, path):
+        with open(path, "wb") as index_file:
+            index_file.write(_INDEX_HEADER.pack(
+                INDEX_MAGIC, INDEX_VERSION, self.span, self.length,
+                len(self.data), zlib.crc32(self.data), len(self.checkpoints)))
+            for checkpoint in self.checkpoints:
+                index_file.write(_CHECKPOINT_HEADER.pack(
+                    checkpoint.out_offset, checkpoint.bit_offset, len(checkpoint.window)))
+                index_file.write(checkpoint.window)
+
+def build_index(data, span=DEFAULT_SPAN):
+    bitreader = deflate.BitReader(data)
+    bitreader.seek(deflate_start_offset(data) * 8)
+    checkpoints = []
+    decoded_data = bytearray()
+    # decoded_data の先頭が伸長後の何バイト目にあたるか
+    base_offset = 0
+    last_out_offset = -span
+    while True:
+        out_offset = base_offset + len(decoded_data)
+        if span <= out_offset - last_out_offset:
+            checkpoints.append(Checkpoint(
+                out_offset, bitreader.tell(), bytes(decoded_data[-WINDOW_SIZE:])))
+            last_out_offset = out_offset
+        if deflate.decode_block(bitreader, decoded_data):
+            if not _start_next_member(data, bitreader):
+                break
+            # 次のメンバーは前のメンバーを参照しないので窓を空にする
+            base_offset += len(decoded_data)
+            decoded_data.clear()
+        # 後方参照に必要な窓だけ残してメモリを抑える
+        elif 4 * WINDOW_SIZE < len(decoded_data):
+            base_offset += len(decoded_data) - WINDOW_SIZE
+            del decoded_data[:-WINDOW_SIZE]
+    return DeflateIndex(data, checkpoints, span, base_offset + len(decoded_data))
+
+def load_index(path, data):
+    with open(path, "rb") as index_file:
+        (magic, version, span, length, compressed_length, crc32,
+            num_checkpoints) = _INDEX_HEADER.unpack(index_file.read(_INDEX_HEADER.size))
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError("not a codeckit deflate index: {}".format(path))
+        if compressed_length != len(data) or crc32 != zlib.crc32(data):
+            raise ValueError("index {} was built for different data".format(path))
+        checkpoints = []
+        for _ in range(num_checkpoints):
+            out_offset, bit_offset, window_size = _CHECKPOINT_HEADER.unpack(
+                index_file.read(_CHECKPOINT_HEADER.size))
+            checkpoints.append(Checkpoint(out_offset, bit_offset, index_file.read(window_size)))
+    return DeflateIndex(data, checkpoints, span, length)
+
+if __name__ == "__main__":
+    import unittest
+    import gzip
+    import zlib
+    import random
+    import os
+    import tempfile
+
+    class TestDeflateIndex(unittest.TestCase):
+        def setUp(self):
+            rand = random.Random(0)
+            words = [bytes(rand.choice(b"abcdefghij") for _ in range(rand.randint(2, 8)))
+                        for _ in range(200)]
+            self.raw = b" ".join(rand.choice(words) for _ in range(60000))
+
+        def assertRandomReads(self, index):
+            rand = random.Random(1)
+            for _ in range(20):
+                offset = rand.randrange(len(self.raw))
+                length = rand.randint(1, 5000)
+                self.assertEqual(index.seek_read(offset, length), self.raw[offset:offset + length])
+            self.assertEqual(index.seek_read(len(self.raw) - 10, 100), self.raw[-10:])
+
+        def test_gzip(self):
+            data = gzip.compress(self.raw, 6)
+            index = build_index(data, span=1 << 16)
+            self.assertEqual(index.length, len(self.raw))
+            self.assertLess(1, len(index.checkpoints))
+            self.assertRandomReads(index)
+
+        def test_zlib_stored_and_save(self):
+            for level in [0, 1]:
+                data = zlib.compress(self.raw, level)
+                index = build_index(data, span=1 << 16)
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    path = os.path.join(tmp_dir, "data.ckzi")
+                    index.save(path)
+                    loaded = load_index(path, data)
+                self.assertEqual(len(loaded.checkpoints), len(index.checkpoints))
+                self.assertRandomReads(loaded)
+
+        def test_concatenated_gzip(self):
+            first = self.raw[:len(self.raw) // 3]
+            second = self.raw[len(first):]
+            data = gzip.compress(first, 6) + gzip.compress(second, 1)
+            index = build_index(data, span=1 << 16)
+            self.assertEqual(index.length, len(self.raw))
+            self.assertEqual(index.seek_read(len(first) - 10, 30), self.raw[len(first) - 10:len(first) + 20])
+            self.assertRandomReads(index)
+            # ゼロ埋めは読み飛ばし、それ以外のゴミはエラーにする
+            self.assertEqual(build_index(data + bytes(16)).length, len(self.raw))
+            with self.assertRaises(ValueError):
+                build_index(data + b"garbage!")
+
+        def test_index_rejects_other_file(self):
+            data = gzip.compress(self.raw, 6)
+            index = build_index(data, span=1 << 16)
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                path = os.path.join(tmp_dir, "data.ckzi")
+                index.save(path)
+                with self.assertRaises(ValueError):
+                    load_index(path, data + gzip.compress(b"more"))
+                # 長さが同じでも中身が違えば使わない
+                other = gzip.compress(self.raw[::-1], 6)
+                other = (other + bytes(len(data)))[:len(data)]
+                with self.assertRaises(ValueError):
+                    load_index(path, other)
+
+        def test_invalid_arguments(self):
+            index = build_index(zlib.compress(self.raw, 6), span=1 << 16)
+            with self.assertRaises(ValueError):
+                index.seek_read(-5, 10)
+            with self.assertRaises(ValueError):
+                index.seek_read(0, -1)
+            for data in [b"", b"\x1f"]:
+                with self.assertRaisesRegex(ValueError, "too short"):
+                    build_index(data)
+
+    unittest.main()
+    exit()
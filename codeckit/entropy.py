@@ -0,0 +1,88 @@
+import numpy
+
+# 全体を数えずに、等間隔に取った数個の窓だけでエントロピーを推定する
+SAMPLE_WINDOW_SIZE = 4096
+SAMPLE_WINDOW_COUNT = 8
+BINCOUNT_LIMIT = 1 << 16
+
+def as_value_array(values):
+    if isinstance(values, (bytes, bytearray, memoryview)):
+        return numpy.frombuffer(values, dtype=numpy.uint8)
+    return numpy.asarray(values)
+
+def value_bit_width(max_value):
+    bit_width = len("{:b}".format(int(max_value)))
+    if bit_width <= 8:
+        return 8
+    elif bit_width <= 16:
+        return 16
+    elif bit_width <= 32:
+        return 32
+    return 64
+
+def sample_windows(values, window_size=SAMPLE_WINDOW_SIZE, window_count=SAMPLE_WINDOW_COUNT):
+    length = len(values)
+    if length <= window_size * window_count:
+        return values
+    if window_count <= 1:
+        return values[:window_size]
+    stride = (length - window_size) // (window_count - 1)
+    starts = numpy.arange(window_count) * stride
+    indices = (starts[:, None] + numpy.arange(window_size)[None, :]).ravel()
+    return values[indices]
+
+def sample_histgram(values, window_size=SAMPLE_WINDOW_SIZE, window_count=SAMPLE_WINDOW_COUNT):
+    sample = sample_windows(values, window_size, window_count)
+    if sample.dtype.kind == "u" and int(sample.max()) < BINCOUNT_LIMIT:
+        counts = numpy.bincount(sample)
+        counts = counts[counts != 0]
+    else:
+        counts = numpy.unique(sample, return_counts=True)[1]
+    return counts, len(sample)
+
+def estimate_entropy(values, window_size=SAMPLE_WINDOW_SIZE, window_count=SAMPLE_WINDOW_COUNT):
+    # 標本から求めた1要素あたりのシャノンエントロピー(ビット)
+    counts, sample_count = sample_histgram(
+        as_value_array(values), window_size, window_count)
+    p = counts / sample_count
+    return float(-numpy.sum(p * numpy.log2(p))), len(counts)
+
+def is_incompressible(values, table_bits_per_symbol=0):
+    # 推定した符号化後のビット数(テーブル込み)が生データ以上なら圧縮しても無駄
+    values = as_value_array(values)
+    if len(values) == 0 or values.dtype.kind not in "ui" or values.min() < 0:
+        return False
+    raw_bits = value_bit_width(values.max())
+    entropy, num_symbols = estimate_entropy(values)
+    estimated_bits = entropy * len(values) + table_bits_per_symbol * num_symbols
+    return raw_bits * len(values) <= estimated_bits
+
+if __name__ == "__main__":
+    import unittest
+    import random
+
+    class TestEntropy(unittest.TestCase):
+        def test_random_bytes_are_incompressible(self):
+            rand = random.Random(0)
+            data = bytes(rand.getrandbits(8) for _ in range(100000))
+            entropy, num_symbols = estimate_entropy(data)
+            self.assertGreater(entropy, 7.9)
+            self.assertEqual(num_symbols, 256)
+            self.assertTrue(is_incompressible(data, 10))
+
+        def test_text_is_compressible(self):
+            with open(__file__, "rb") as text_file:
+                data = text_file.read() * 20
+            self.assertLess(estimate_entropy(data)[0], 6.0)
+            self.assertFalse(is_incompressible(data, 10))
+
+        def test_single_window(self):
+            data = bytes(range(256)) * 100
+            self.assertEqual(len(sample_windows(as_value_array(data), 1024, 1)), 1024)
+            self.assertEqual(estimate_entropy(data, 1024, 1)[0], 8.0)
+
+        def test_constant(self):
+            self.assertEqual(estimate_entropy(bytes(5000))[0], 0.0)
+
+    unittest.main()
+    exit()
@@ -0,0 +1,229 @@
+import numpy
+from . import kernels
+from . import entropy
+
+# tANS (FSE) エントロピー符号
+# 出現頻度を 2**table_log に正規化し、状態遷移表の参照だけで符号化・復号する
+MIN_TABLE_LOG = 5
+MAX_TABLE_LOG = 15
+DEFAULT_TABLE_LOG = 11
+NUM_STATES = 4
+
+def __choose_table_log(num_values, num_symbols):
+    table_log = min(DEFAULT_TABLE_LOG, max(MIN_TABLE_LOG, (num_values - 1).bit_length()))
+    # 全記号に最低1枠を割り当てても余裕があるように記号数の2倍以上にする
+    table_log = max(table_log, num_symbols.bit_length() + 1)
+    if MAX_TABLE_LOG < table_log:
+        raise ValueError("too many symbols for tANS: {}".format(num_symbols))
+    return table_log
+
+def __normalize_counts(counts, table_log):
+    table_size = 1 << table_log
+    scaled = counts * table_size / numpy.sum(counts)
+    normalized = numpy.maximum(numpy.floor(scaled).astype(numpy.int64), 1)
+    diff = table_size - int(numpy.sum(normalized))
+    if 0 < diff:
+        # 切り捨てた端数の大きい記号から順に1ずつ足す
+        order = numpy.argsort(normalized - scaled, kind="stable")
+        normalized[order[:diff]] += 1
+    while diff < 0:
+        # 最低1枠に切り上げた分は頻度の大きい記号から削る
+        normalized[numpy.argmax(normalized)] -= 1
+        diff += 1
+    return normalized
+
+def __spread_symbols(normalized, table_log):
+    # FSE と同じ奇数ステップで表全体に記号を散らす
+    table_size = 1 << table_log
+    mask = table_size - 1
+    step = (table_size >> 1) + (table_size >> 3) + 3
+    spread = numpy.zeros(table_size, dtype=numpy.int64)
+    position = 0
+    for s, count in enumerate(normalized.tolist()):
+        for _ in range(count):
+            spread[position] = s
+            position = (position + step) & mask
+    return spread
+
+def __make_encode_table(normalized, spread, table_log):
+    table_size = 1 << table_log
+    cumulative = numpy.r_[0, numpy.cumsum(normalized)[:-1]]
+    # 同じ記号の位置は昇順に並べる(復号表と対応させるため)
+    order = numpy.argsort(spread, kind="stable")
+    state_table = (order + table_size).astype(numpy.int64)
+
+    delta_nb_bits = numpy.zeros(len(normalized), dtype=numpy.int64)
+    for s, count in enumerate(normalized.tolist()):
+        if count == 1:
+            delta_nb_bits[s] = (table_log << 16) - table_size
+        else:
+            max_bits_out = table_log - ((count - 1).bit_length() - 1)
+            delta_nb_bits[s] = (max_bits_out << 16) - (count << max_bits_out)
+    delta_find_state = cumulative - normalized
+    return delta_nb_bits, delta_find_state, state_table
+
+def __make_decode_table(normalized, spread, table_log):
+    table_size = 1 << table_log
+    next_count = normalized.tolist()
+    nb_bits_table = numpy.zeros(table_size, dtype=numpy.int64)
+    base_table = numpy.zeros(table_size, dtype=numpy.int64)
+    for state, s in enumerate(spread.tolist()):
+        y = next_count[s]
+        next_count[s] += 1
+        nb_bits = table_log - (y.bit_length() - 1)
+        nb_bits_table[state] = nb_bits
+        base_table[state] = (y << nb_bits) - table_size
+    return spread, nb_bits_table, base_table
+
+def __write_varint(header, value):
+    value = int(value)
+    while 0x80 <= value:
+        header.append((value & 0x7f) | 0x80)
+        value = value >> 7
+    header.append(value)
+
+def __read_varint(byte_array, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = int(byte_array[offset])
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, offset
+
+def __serialize_header(table_log, num_states, value_bytes, num_values,
+                       symbols, normalized, final_states, bit_count):
+    header = [table_log, num_states, value_bytes]
+    __write_varint(header, num_values)
+    __write_varint(header, len(symbols))
+    last_symbol = -1
+    for symbol, count in zip(symbols.tolist(), normalized.tolist()):
+        __write_varint(header, symbol - last_symbol - 1)
+        __write_varint(header, count - 1)
+        last_symbol = symbol
+    for state in final_states:
+        __write_varint(header, state)
+    __write_varint(header, bit_count)
+    return bytes(header)
+
+def __deserialize_header(byte_array):
+    table_log = int(byte_array[0])
+    num_states = int(byte_array[1])
+    value_bytes = int(byte_array[2])
+    offset = 3
+    num_values, offset = __read_varint(byte_array, offset)
+    num_symbols, offset = __read_varint(byte_array, offset)
+    symbols = []
+    normalized = []
+    last_symbol = -1
+    for _ in range(num_symbols):
+        delta, offset = __read_varint(byte_array, offset)
+        count, offset = __read_varint(byte_array, offset)
+        last_symbol = last_symbol + delta + 1
+        symbols.append(last_symbol)
+        normalized.append(count + 1)
+    final_states = []
+    for _ in range(num_states):
+        state, offset = __read_varint(byte_array, offset)
+        final_states.append(state)
+    bit_count, offset = __read_varint(byte_array, offset)
+    return (table_log, value_bytes, num_values, symbols,
+            numpy.array(normalized, dtype=numpy.int64), final_states, bit_count, offset)
+
+def encode(values, num_states=NUM_STATES):
+    values = entropy.as_value_array(values).ravel()
+    if values.dtype.kind not in "ui":
+        raise ValueError("tANS input must be integers: {}".format(values.dtype))
+    if 0 < len(values) and values.min() < 0:
+        raise ValueError("tANS input must be non-negative")
+    if len(values) == 0:
+        return __serialize_header(MIN_TABLE_LOG, num_states, 1, 0,
+                                  numpy.zeros(0, dtype=numpy.int64),
+                                  numpy.zeros(0, dtype=numpy.int64), [0] * num_states, 0)
+    symbols, symbol_indices, counts = numpy.unique(
+        values, return_inverse=True, return_counts=True)
+    table_log = __choose_table_log(len(values), len(symbols))
+    normalized = __normalize_counts(counts, table_log)
+    spread = __spread_symbols(normalized, table_log)
+    delta_nb_bits, delta_find_state, state_table = __make_encode_table(
+        normalized, spread, table_log)
+
+    byte_array = numpy.zeros((len(values) * table_log + 7) // 8, dtype=numpy.uint8)
+    states = numpy.full(num_states, 1 << table_log, dtype=numpy.int64)
+    bit_count = kernels.fse_encode(
+        kernels.index_array(symbol_indices.ravel()),
+        kernels.index_array(delta_nb_bits), kernels.index_array(delta_find_state),
+        kernels.index_array(state_table), states, byte_array)
+    final_states = states - (1 << table_log)
+
+    value_bytes = entropy.value_bit_width(symbols[-1]) // 8
+    header = __serialize_header(table_log, num_states, value_bytes, len(values),
+                                symbols, normalized, [int(v) for v in final_states], bit_count)
+    return header + byte_array[:(bit_count + 7) // 8].tobytes()
+
+def decode(byte_array):
+    (table_log, value_bytes, num_values, symbols, normalized,
+        final_states, bit_count, offset) = __deserialize_header(byte_array)
+    value_type = numpy.dtype("<u{}".format(value_bytes))
+    if num_values == 0:
+        return numpy.zeros(0, dtype=value_type)
+    spread = __spread_symbols(normalized, table_log)
+    symbol_table, nb_bits_table, base_table = __make_decode_table(
+        normalized, spread, table_log)
+    decoded_indices = kernels.fse_decode(
+        kernels.byte_array(byte_array[offset:]), bit_count,
+        numpy.array(final_states, dtype=numpy.int64),
+        kernels.index_array(symbol_table), kernels.index_array(nb_bits_table),
+        kernels.index_array(base_table), numpy.zeros(num_values, dtype=numpy.int64))
+    return numpy.array(symbols, dtype=value_type)[decoded_indices]
+
+if __name__ == "__main__":
+    import unittest
+    import random
+
+    class TestFSE(unittest.TestCase):
+        def assertRoundtrip(self, values, value_type=numpy.uint8):
+            encoded = encode(values)
+            decoded = decode(encoded)
+            self.assertEqual(decoded.dtype, value_type)
+            self.assertTrue(numpy.array_equal(decoded, entropy.as_value_array(values)))
+            return encoded
+
+        def test_text(self):
+            with open(__file__, "rb") as text_file:
+                data = text_file.read()
+            encoded = self.assertRoundtrip(data)
+            self.assertLess(len(encoded), len(data) * 0.7)
+
+        def test_skewed(self):
+            rand = random.Random(0)
+            data = bytes(0 if rand.random() < 0.95 else rand.randint(1, 3) for _ in range(20000))
+            encoded = self.assertRoundtrip(data)
+            # ハフマンでは1記号1ビット以上かかる分布
+            self.assertLess(len(encoded), len(data) // 8)
+
+        def test_invalid_input(self):
+            with self.assertRaisesRegex(ValueError, "non-negative"):
+                encode(numpy.array([1, -2, 3]))
+            with self.assertRaisesRegex(ValueError, "integers"):
+                encode(numpy.array([0.5, 1.5]))
+
+        def test_edge_cases(self):
+            self.assertRoundtrip(b"")
+            self.assertRoundtrip(b"a")
+            self.assertRoundtrip(bytes(1000))
+            self.assertRoundtrip(bytes(range(256)))
+            self.assertRoundtrip(numpy.array([3, 70000, 5, 3, 3], dtype=numpy.uint32), numpy.uint32)
+            # 多次元配列は平坦化して符号化する
+            matrix = numpy.arange(3000, dtype=numpy.uint8).reshape(1000, 3)
+            self.assertTrue(numpy.array_equal(decode(encode(matrix)), matrix.ravel()))
+            self.assertTrue(numpy.array_equal(decode(encode(numpy.array([[1, 2], [3, 4]]))), [1, 2, 3, 4]))
+            for num_states in [1, 2, 3, 4]:
+                data = b"abracadabra" * 10
+                self.assertTrue(numpy.array_equal(
+                    decode(encode(data, num_states)), numpy.frombuffer(data, dtype=numpy.uint8)))
+
+    unittest.main()
+    exit()
@@ -1,5 +1,18 @@
 import numpy
-from .bitstreamer import *
+from .bitstreamer import BitWriter, BitReader
+from . import kernels
+from . import entropy
+
+# 先頭バイトがこの値なら非圧縮(ハフマン符号長として255は現れない)
+STORED_BLOCK_MARKER = 0xff
+# 先頭バイトがこの値ならセグメントごとに複数テーブルを切り替える形式
+MULTI_TABLE_MARKER = 0xfe
+MULTI_TABLE_HEADER_SIZE = 15
+SEGMENT_SIZE = 1024
+MAX_TABLES = 6
+REFINE_ITERATIONS = 4
+# テーブルに無い記号の仮のコスト(ビット)
+UNSEEN_SYMBOL_COST = 20
 
 def __make_histgram(values):
     histgram = {}
@@ -57,6 +70,9 @@ def __make_huffman_tree(histgram):
             leaf.code_length += 1
             parent_index = nodes[parent_index].parent_index
         #leaf.code_length += 1
+        # 記号が1種類だけだと符号長が0になり復号できないので1ビット割り当てる
+        if num_leaf == 1:
+            leaf.code_length = 1
         nodes[i] = leaf
         total_bit_count = total_bit_count + leaf.code_length * leaf.count
 
@@ -185,79 +201,84 @@ def __deserialize_data_header(byte_array):
     bit_count = bit_count + byte_count * 8
     return bit_count, 2 + byte_count_size
 
-def __encode_data_to_byte_array(symbols, code_table, data, bit_count):
-    code_infos = {}
-    for symbol, code in zip(symbols, code_table):
-        code_infos[symbol.key] = (code, symbol.code_length)
+def __reversed_codes(symbols, code_table):
+    # 符号は MSB から書き出すので、カーネルが LSB 側から書けるように反転しておく
+    return [kernels.reverse_bit_order(int(code), symbol.code_length)
+            for symbol, code in zip(symbols, code_table)]
 
-    total_byte_count = (bit_count + 7) // 8
-    bitwriter = BitWriter(int(total_byte_count))
-    for i, v in enumerate(data):
-        code_info = code_infos[v]
-        bitwriter.write(code_info[0], code_info[1])
+def __write_codes(symbol_indices, codes, code_lengths, bit_count):
+    # 記号ごとのループはカーネルで回す
+    byte_array = numpy.zeros((int(bit_count) + 7) // 8, dtype=numpy.uint8)
+    kernels.huffman_encode(
+        kernels.index_array(symbol_indices), kernels.index_array(codes),
+        kernels.index_array(code_lengths), byte_array)
+    return byte_array
 
-    byte_array, last_bit_count = bitwriter.get()
-    return byte_array, last_bit_count
+def __encode_data_to_byte_array(symbols, code_table, data, bit_count):
+    keys = numpy.array([symbol.key for symbol in symbols], dtype=numpy.int64)
+    order = numpy.argsort(keys, kind="stable")
+    values = entropy.as_value_array(data).ravel().astype(numpy.int64)
+    symbol_indices = order[numpy.searchsorted(keys[order], values)]
+    byte_array = __write_codes(
+        symbol_indices, __reversed_codes(symbols, code_table),
+        [symbol.code_length for symbol in symbols], bit_count)
+    return byte_array, int(bit_count) % 8
 
 def __make_bit_string(value, bit_count):
     f = "{:0" + str(bit_count) + "b}"
     return f.format(value)
 
 def __make_huffman_code_tree(symbols, code_table):
-    class Node:
-        def __init__(self):
-            self.c0 = None
-            self.c1 = None
-            self.is_leaf = False
-            self.key = None
-
-    root = Node()
+    # ノードを配列で表現した木を構築する
+    # child0/child1 は子ノードの番号(無ければ-1)、keys は葉の記号(葉以外は-1)
+    child0 = [-1]
+    child1 = [-1]
+    keys = [-1]
     for symbol, code in zip(symbols, code_table):
         bit_string = __make_bit_string(code, symbol.code_length)
-        node = root
+        node = 0
         for bit in bit_string:
-            if bit == "0":
-                if node.c0 is None:
-                    node.c0 = Node()
-                node = node.c0
-            else:
-                if node.c1 is None:
-                    node.c1 = Node()
-                node = node.c1
-        node.is_leaf = True
-        node.key = symbol.key
+            children = child0 if bit == "0" else child1
+            if children[node] < 0:
+                children[node] = len(keys)
+                child0.append(-1)
+                child1.append(-1)
+                keys.append(-1)
+            node = children[node]
+        keys[node] = symbol.key
 
-    return root
+    return kernels.index_array(child0), kernels.index_array(child1), kernels.index_array(keys)
 
 def __decode_data_to_byte_array(symbols, code_table, data, bit_count):
-    root = __make_huffman_code_tree(symbols, code_table)
-    bit_reader = BitReader(data)
-    node = root
-    decoded_values = []
-    for i in range(bit_count):
-        v = bit_reader.read(1)
-        if v == 0:
-            node = node.c0
-        else:
-            node = node.c1
-        if node.is_leaf == True:
-            decoded_values.append(node.key)
-            node = root
+    child0, child1, keys = __make_huffman_code_tree(symbols, code_table)
+    decoded_values = kernels.huffman_tree_walk(data, int(bit_count), child0, child1, keys)
 
     max_symbol = max(symbols, key=(lambda x: x.key))
-    bit_width = __bit_width(max_symbol.key)
-    if bit_width <= 8:
-        value_type = numpy.uint8
-    elif bit_width <= 16:
-        value_type = numpy.uint16
-    elif bit_width <= 32:
-        value_type = numpy.uint32
-    else:
-        value_type = numpy.uint64
+    value_type = __value_type(max_symbol.key)
 
     return numpy.array(decoded_values, value_type)
 
+def __value_type(max_value):
+    return numpy.dtype("<u{}".format(entropy.value_bit_width(max_value) // 8))
+
+def __encode_stored(values):
+    value_type = __value_type(values.max())
+    header = numpy.array([STORED_BLOCK_MARKER, value_type.itemsize], dtype=numpy.uint8)
+    return header.tobytes() + values.astype(value_type).tobytes()
+
+def __decode_stored(byte_array):
+    value_type = numpy.dtype("<u{}".format(int(byte_array[1])))
+    return numpy.frombuffer(byte_array, dtype=numpy.uint8, offset=2).view(value_type).copy()
+
 def encode(values):
+    # 乱数や圧縮済みデータはテーブル構築と符号化を省いてそのまま格納する
+    value_array = entropy.as_value_array(values)
+    if 0 < len(value_array) and value_array.dtype.kind in "ui" and value_array.min() < 0:
+        raise ValueError("huffman input must be non-negative")
+    if 0 < len(value_array) and value_array.dtype.kind in "ui":
+        table_bits_per_symbol = __bit_width(int(value_array.max())) + 4
+        if entropy.is_incompressible(value_array, table_bits_per_symbol):
+            return __encode_stored(value_array)
     histgram = __make_histgram(values)
     huffman_tree_leafs, bit_count = __make_huffman_tree(histgram)
     normalized_huffman_tree = __normalize_huffman_tree(huffman_tree_leafs)
@@ -270,7 +291,181 @@ def encode(values):
     #print("data size:", len(byte_array))
     return (numpy.r_[header, data_header, byte_array]).astype(numpy.uint8).tobytes()
 
+def __segment_histgrams(symbol_indices, num_symbols, segment_size):
+    num_segments = (len(symbol_indices) + segment_size - 1) // segment_size
+    segment_ids = numpy.arange(len(symbol_indices)) // segment_size
+    histgrams = numpy.bincount(segment_ids * num_symbols + symbol_indices,
+                               minlength=num_segments * num_symbols)
+    return histgrams.reshape(num_segments, num_symbols)
+
+def __make_group_huffman_tree(counts, symbols):
+    histgram = {str(symbols[i]): int(count) for i, count in enumerate(counts) if 0 < count}
+    return __make_huffman_tree(histgram)
+
+def __group_code_lengths(counts, symbols):
+    huffman_tree_leafs, __unuse = __make_group_huffman_tree(counts, symbols)
+    code_lengths = numpy.zeros(len(symbols), dtype=numpy.int64)
+    for leaf in huffman_tree_leafs:
+        code_lengths[numpy.searchsorted(symbols, int(leaf.key))] = leaf.code_length
+    return code_lengths
+
+def __cluster_segments(segment_histgrams, symbols, num_tables):
+    # 初期値は位置で等分し、各セグメントを最も安く符号化できるテーブルへ割り当て直す
+    num_segments = len(segment_histgrams)
+    selectors = numpy.arange(num_segments) * num_tables // num_segments
+    for _ in range(REFINE_ITERATIONS):
+        cost_tables = []
+        for table in numpy.unique(selectors):
+            group_counts = segment_histgrams[selectors == table].sum(axis=0)
+            cost_tables.append(__group_code_lengths(group_counts, symbols))
+        cost_tables = numpy.array(cost_tables).T
+        cost_tables[cost_tables == 0] = UNSEEN_SYMBOL_COST
+        new_selectors = numpy.argmin(segment_histgrams @ cost_tables, axis=1)
+        if numpy.array_equal(new_selectors, selectors):
+            break
+        selectors = new_selectors
+    # 使われなかったテーブルを詰める
+    __unuse, selectors = numpy.unique(selectors, return_inverse=True)
+    return selectors.ravel()
+
+def __byte_aligned(bit_count):
+    return (bit_count + 7) // 8 * 8
+
+def __plain_bit_count(segment_histgrams, symbols):
+    # 通常の encode の出力(テーブル1つ・データヘッダ・データ)のビット数
+    huffman_tree_leafs, data_bit_count = __make_group_huffman_tree(
+        segment_histgrams.sum(axis=0), symbols)
+    header = __serialize_normalized_huffman_tree(__normalize_huffman_tree(huffman_tree_leafs))
+    data_header = __serialize_data_header(data_bit_count)
+    return (len(header) + len(data_header)) * 8 + __byte_aligned(int(data_bit_count))
+
+def __multi_table_bit_count(segment_histgrams, symbols, selectors):
+    # データ・テーブル・選択子を合わせた出力のビット数
+    num_tables = int(selectors.max()) + 1
+    bit_count = MULTI_TABLE_HEADER_SIZE * 8
+    bit_count += __byte_aligned(len(selectors) * __bit_width(num_tables - 1))
+    data_bit_count = 0
+    for table in range(num_tables):
+        group_counts = segment_histgrams[selectors == table].sum(axis=0)
+        huffman_tree_leafs, group_bit_count = __make_group_huffman_tree(group_counts, symbols)
+        header = __serialize_normalized_huffman_tree(__normalize_huffman_tree(huffman_tree_leafs))
+        bit_count += len(header) * 8
+        data_bit_count += int(group_bit_count)
+    bit_count += len(__serialize_data_header(data_bit_count)) * 8
+    return bit_count + __byte_aligned(data_bit_count)
+
+def encode_multi_table(values, segment_size=SEGMENT_SIZE, max_tables=MAX_TABLES):
+    # bzip2 と同様に、セグメントごとに K 個の共有テーブルから1つを選んで符号化する
+    # テーブルを増やしてもヘッダ込みで小さくならなければ通常の encode と同じ出力になる
+    value_array = entropy.as_value_array(values).ravel()
+    # 負の値などの扱いは encode に任せる
+    if (len(value_array) <= segment_size or value_array.dtype.kind not in "ui"
+            or value_array.min() < 0):
+        return encode(values)
+    symbols, symbol_indices, __unuse = numpy.unique(
+        value_array, return_inverse=True, return_counts=True)
+    segment_histgrams = __segment_histgrams(symbol_indices.ravel(), len(symbols), segment_size)
+    num_segments = len(segment_histgrams)
+
+    best_selectors = None
+    best_bit_count = None
+    for num_tables in range(2, min(max_tables, num_segments) + 1):
+        selectors = __cluster_segments(segment_histgrams, symbols, num_tables)
+        if int(selectors.max()) == 0:
+            continue
+        bit_count = __multi_table_bit_count(segment_histgrams, symbols, selectors)
+        if best_bit_count is None or bit_count < best_bit_count:
+            best_selectors = selectors
+            best_bit_count = bit_count
+    if best_selectors is None or __plain_bit_count(segment_histgrams, symbols) <= best_bit_count:
+        return encode(values)
+    selectors = best_selectors
+    num_tables = int(selectors.max()) + 1
+    selector_bits = __bit_width(num_tables - 1)
+
+    # 全テーブルの符号を (テーブル番号, 記号番号) の順に1つの表へ並べる
+    num_symbols = len(symbols)
+    tables = []
+    codes = numpy.zeros(num_tables * num_symbols, dtype=numpy.int64)
+    code_lengths = numpy.zeros(num_tables * num_symbols, dtype=numpy.int64)
+    for table in range(num_tables):
+        group_counts = segment_histgrams[selectors == table].sum(axis=0)
+        huffman_tree_leafs, __unuse = __make_group_huffman_tree(group_counts, symbols)
+        normalized_huffman_tree = __normalize_huffman_tree(huffman_tree_leafs)
+        code_table = __make_huffman_code_table(normalized_huffman_tree)
+        symbol_offsets = table * num_symbols + numpy.searchsorted(
+            symbols, [symbol.key for symbol in normalized_huffman_tree])
+        codes[symbol_offsets] = __reversed_codes(normalized_huffman_tree, code_table)
+        code_lengths[symbol_offsets] = [symbol.code_length for symbol in normalized_huffman_tree]
+        tables.append(normalized_huffman_tree)
+
+    code_indices = numpy.repeat(selectors, segment_size)[:len(value_array)] * num_symbols
+    code_indices += symbol_indices.ravel()
+    bit_count = int(numpy.sum(code_lengths[code_indices]))
+    byte_array = __write_codes(code_indices, codes, code_lengths, bit_count)
+
+    selector_writer = BitWriter((len(selectors) * selector_bits + 7) // 8)
+    for table in selectors.tolist():
+        selector_writer.write(table, selector_bits)
+    selector_array, __unuse = selector_writer.get()
+
+    header = numpy.zeros(MULTI_TABLE_HEADER_SIZE, dtype=numpy.uint8)
+    header[0] = MULTI_TABLE_MARKER
+    header[1] = num_tables
+    header[2] = selector_bits
+    header[3:7] = numpy.frombuffer(segment_size.to_bytes(4, "little"), dtype=numpy.uint8)
+    header[7:15] = numpy.frombuffer(len(value_array).to_bytes(8, "little"), dtype=numpy.uint8)
+    table_headers = [__serialize_normalized_huffman_tree(table) for table in tables]
+    data_header = __serialize_data_header(bit_count)
+    return (numpy.r_[tuple([header] + table_headers + [selector_array, data_header, byte_array])]
+            ).astype(numpy.uint8).tobytes()
+
+def __decode_multi_table(byte_array):
+    num_tables = int(byte_array[1])
+    selector_bits = int(byte_array[2])
+    segment_size = int.from_bytes(bytes(byte_array[3:7]), "little")
+    num_values = int.from_bytes(bytes(byte_array[7:15]), "little")
+    offset = MULTI_TABLE_HEADER_SIZE
+
+    roots = []
+    child0 = []
+    child1 = []
+    keys = []
+    max_key = 0
+    for _ in range(num_tables):
+        symbols, byte_count = __deserialize_normalized_huffman_tree(byte_array[offset:])
+        offset += byte_count
+        code_table = __make_huffman_code_table(symbols)
+        # 全テーブルの木を1つの配列に連結し、各テーブルの根の番号を覚えておく
+        table_child0, table_child1, table_keys = [
+            numpy.asarray(a, dtype=numpy.int64) for a in __make_huffman_code_tree(symbols, code_table)]
+        node_offset = len(keys)
+        roots.append(node_offset)
+        child0.extend(numpy.where(table_child0 < 0, -1, table_child0 + node_offset).tolist())
+        child1.extend(numpy.where(table_child1 < 0, -1, table_child1 + node_offset).tolist())
+        keys.extend(table_keys.tolist())
+        max_key = max(max_key, max(symbol.key for symbol in symbols))
+
+    num_segments = (num_values + segment_size - 1) // segment_size
+    selector_byte_count = (num_segments * selector_bits + 7) // 8
+    selector_reader = BitReader(byte_array[offset:offset + selector_byte_count])
+    selectors = [selector_reader.read(selector_bits) for _ in range(num_segments)]
+    offset += selector_byte_count
+    bit_count, byte_count = __deserialize_data_header(byte_array[offset:])
+    offset += byte_count
+
+    decoded_values = kernels.huffman_multi_tree_walk(
+        kernels.byte_array(byte_array[offset:]), num_values, segment_size,
+        kernels.index_array(selectors), kernels.index_array(roots),
+        kernels.index_array(child0), kernels.index_array(child1), kernels.index_array(keys),
+        numpy.zeros(num_values, dtype=numpy.int64))
+    return numpy.array(decoded_values, __value_type(max_key))
+
 def decode(byte_array):
+    if byte_array[0] == STORED_BLOCK_MARKER:
+        return __decode_stored(byte_array)
+    if byte_array[0] == MULTI_TABLE_MARKER:
+        return __decode_multi_table(byte_array)
     offset = 0
     symbols, byte_count = __deserialize_normalized_huffman_tree(byte_array)
     offset += byte_count
@@ -282,13 +477,49 @@ def decode(byte_array):
     return decoded_values
 
 if __name__ == "__main__":
-    with open("huffman.py", "rb") as bin_file:
-        binary = bytes(bin_file.read())
-    data = numpy.frombuffer(binary, dtype=numpy.uint8)
-    encoded = encode(data)
-    decoded = decode(encoded)
-    print(len(encoded), type(encoded))
-    print(len(data), type(data[0]))
-    print(len(decoded), type(decoded[0]))
-    v = numpy.subtract(data, decoded)
-    print(numpy.sum(abs(v)))
+    import unittest
+    import random
+
+    class TestHuffman(unittest.TestCase):
+        def setUp(self):
+            with open(__file__, "rb") as text_file:
+                self.text = text_file.read()
+
+        def assertRoundtrip(self, values, encoded):
+            self.assertTrue(numpy.array_equal(decode(encoded), entropy.as_value_array(values)))
+
+        def test_text(self):
+            encoded = encode(self.text)
+            self.assertLess(len(encoded), len(self.text) * 0.7)
+            self.assertRoundtrip(self.text, encoded)
+
+        def test_stores_random_bytes(self):
+            rand = random.Random(2)
+            data = bytes(rand.getrandbits(8) for _ in range(50000))
+            encoded = encode(data)
+            # 印、値のバイト幅、生データの順に並ぶ
+            self.assertEqual(encoded[0], STORED_BLOCK_MARKER)
+            self.assertEqual(encoded[1], 1)
+            self.assertEqual(encoded[2:], data)
+            self.assertRoundtrip(data, encoded)
+
+        def test_multi_table_for_drifting_input(self):
+            # 分布が途中で変わる入力だけ複数テーブルになり、通常の encode より小さくなる
+            rand = random.Random(2)
+            data = self.text + bytes(rand.choice(b"ACGT") for _ in range(20000))
+            encoded = encode_multi_table(data, segment_size=256)
+            self.assertEqual(encoded[0], MULTI_TABLE_MARKER)
+            self.assertLess(len(encoded), len(encode(data)))
+            self.assertRoundtrip(data, encoded)
+
+        def test_multi_table_falls_back_for_stationary_input(self):
+            rand = random.Random(3)
+            data = bytes(rand.choice(b"ACGT") for _ in range(20000))
+            self.assertEqual(encode_multi_table(data, segment_size=256), encode(data))
+
+        def test_invalid_input(self):
+            with self.assertRaisesRegex(ValueError, "non-negative"):
+                encode(numpy.array([-1, 2, -1, 3]))
+
+    unittest.main()
+    exit()
@@ -0,0 +1,490 @@
+import os
+import importlib.util
+
+# ビット入出力と復号ループのホットパスを差し替え可能にするカーネル層
+# 未指定(auto)なら numba が入っていれば JIT 版、無ければ純 Python 版を使う
+# numba は import と JIT コンパイルだけで数百ミリ秒〜1秒程度かかる(キャッシュが無ければさらに遅い)。
+# 小さなレコードを1つ伸長して終わるような短命なプロセスでは
+# CODECKIT_KERNEL_BACKEND=python を指定して純 Python 版に固定する
+# バックエンドは最初にカーネルを使うときに決まるので、import しただけでは numba も numpy も読み込まない
+# 出力用の配列は呼び出し側で確保して渡す
+BACKEND_ENV = "CODECKIT_KERNEL_BACKEND"
+
+def _reverse_bit_order(value, bit_count):
+    # 下位 bit_count ビットだけを反転する(それより上のビットは捨てる)
+    reversed_value = 0
+    for _ in range(bit_count):
+        reversed_value = (reversed_value << 1) | (value & 1)
+        value >>= 1
+    return reversed_value
+
+def _read_bits(byte_array, byte_offset, tmp_byte, remain_bit_count, bit_count):
+    # LSB側から順に bit_count ビット読み出す
+    value = 0
+    write_offset = 0
+    while 0 < bit_count:
+        if remain_bit_count == 0:
+            tmp_byte = int(byte_array[byte_offset])
+            remain_bit_count = 8
+            byte_offset += 1
+        write_bit_count = min(remain_bit_count, bit_count)
+        bit_mask = (1 << write_bit_count) - 1
+        value |= (tmp_byte & bit_mask) << write_offset
+        tmp_byte = tmp_byte >> write_bit_count
+        remain_bit_count -= write_bit_count
+        bit_count -= write_bit_count
+        write_offset += write_bit_count
+    return value, byte_offset, tmp_byte, remain_bit_count
+
+def _write_bits(byte_array, byte_offset, bit_offset, tmp_byte, value, bits):
+    # value の LSB側から順に bits ビット書き込む
+    while 0 < bits:
+        if 0 < bit_offset:
+            if 8 <= bit_offset + bits:
+                remain_bits = 8 - bit_offset
+                bit_mask = (1 << remain_bits) - 1
+                byte_array[byte_offset] = tmp_byte | ((value & bit_mask) << bit_offset)
+                byte_offset += 1
+                value = value >> remain_bits
+                bits -= remain_bits
+                bit_offset = 0
+                tmp_byte = 0
+            else:
+                bit_mask = (1 << bits) - 1
+                tmp_byte = tmp_byte | ((value & bit_mask) << bit_offset)
+                bit_offset += bits
+                bits = 0
+        elif 8 <= bits:
+            byte_array[byte_offset] = value & 0x000000ff
+            byte_offset += 1
+            bits -= 8
+            value = value >> 8
+        else:
+            bit_offset = bits
+            tmp_byte = value & ((1 << bits) - 1)
+            bits = 0
+    return byte_offset, bit_offset, tmp_byte
+
+def _decode_symbol(byte_array, byte_offset, tmp_byte, remain_bit_count, child0, child1, keys):
+    # 平坦化したハフマン木を1ビットずつ辿り、葉に着いたらその記号を返す
+    node = 0
+    while True:
+        if remain_bit_count == 0:
+            tmp_byte = int(byte_array[byte_offset])
+            remain_bit_count = 8
+            byte_offset += 1
+        bit = tmp_byte & 1
+        tmp_byte = tmp_byte >> 1
+        remain_bit_count -= 1
+        if bit == 0:
+            node = child0[node]
+        else:
+            node = child1[node]
+        if node < 0:
+            raise ValueError("invalid huffman code")
+        if 0 <= keys[node]:
+            return keys[node], byte_offset, tmp_byte, remain_bit_count
+
+def _huffman_tree_walk(byte_array, bit_count, child0, child1, keys):
+    decoded_values = []
+    node = 0
+    for i in range(bit_count):
+        bit = (byte_array[i >> 3] >> (i & 7)) & 1
+        if bit == 0:
+            node = child0[node]
+        else:
+            node = child1[node]
+        if node < 0:
+            raise ValueError("invalid huffman code")
+        if 0 <= keys[node]:
+            decoded_values.append(keys[node])
+            node = 0
+    return decoded_values
+
+def _huffman_multi_tree_walk(byte_array, num_values, segment_size, selectors,
+                             roots, child0, child1, keys, decoded_values):
+    # セグメントごとに選択子が指すテーブルの根から辿る
+    bit_pos = 0
+    for segment in range(len(selectors)):
+        root = roots[selectors[segment]]
+        for i in range(segment * segment_size, min((segment + 1) * segment_size, num_values)):
+            node = root
+            while True:
+                bit = (byte_array[bit_pos >> 3] >> (bit_pos & 7)) & 1
+                bit_pos += 1
+                if bit == 0:
+                    node = child0[node]
+                else:
+                    node = child1[node]
+                if node < 0:
+                    raise ValueError("invalid huffman code")
+                if 0 <= keys[node]:
+                    break
+            decoded_values[i] = keys[node]
+    return decoded_values
+
+def _make_inflate_block(read_bits, decode_symbol):
+    # ビット読み出しと記号の復号はバックエンドごとの関数を閉じ込めて使う
+    # (numba では JIT 済みの関数を渡すので、ブロック全体が1回の呼び出しで済む)
+    def _inflate_block(byte_array, byte_offset, tmp_byte, remain_bit_count,
+                       literal_child0, literal_child1, literal_keys,
+                       distance_child0, distance_child1, distance_keys,
+                       length_base, length_extra, distance_base, distance_extra,
+                       out, out_offset):
+        # ブロック終端の記号(256)まで復号して out に書き込む
+        # out の残りが最長一致(258バイト)に満たなくなったら途中で返すので、
+        # 呼び出し側で out を伸ばして続きから呼び直す
+        while out_offset + 258 <= len(out):
+            symbol, byte_offset, tmp_byte, remain_bit_count = decode_symbol(
+                byte_array, byte_offset, tmp_byte, remain_bit_count,
+                literal_child0, literal_child1, literal_keys)
+            if symbol < 256:
+                out[out_offset] = symbol
+                out_offset += 1
+            elif symbol == 256:
+                return byte_offset, tmp_byte, remain_bit_count, out_offset, True
+            else:
+                symbol -= 257
+                if len(length_base) <= symbol:
+                    raise ValueError("invalid length code")
+                extra, byte_offset, tmp_byte, remain_bit_count = read_bits(
+                    byte_array, byte_offset, tmp_byte, remain_bit_count, length_extra[symbol])
+                length = length_base[symbol] + extra
+                symbol, byte_offset, tmp_byte, remain_bit_count = decode_symbol(
+                    byte_array, byte_offset, tmp_byte, remain_bit_count,
+                    distance_child0, distance_child1, distance_keys)
+                if len(distance_base) <= symbol:
+                    raise ValueError("invalid distance code")
+                extra, byte_offset, tmp_byte, remain_bit_count = read_bits(
+                    byte_array, byte_offset, tmp_byte, remain_bit_count, distance_extra[symbol])
+                distance = distance_base[symbol] + extra
+                if out_offset < distance:
+                    raise ValueError("distance too far back")
+                # 参照元と書き込み先が重なる場合があるので1バイトずつコピーする
+                for i in range(out_offset, out_offset + length):
+                    out[i] = out[i - distance]
+                out_offset += length
+        return byte_offset, tmp_byte, remain_bit_count, out_offset, False
+    return _inflate_block
+
+def _huffman_encode(symbol_indices, codes, code_lengths, byte_array):
+    # 符号は LSB 側から書き出せるようにビットを反転したものを渡す
+    bit_pos = 0
+    for i in range(len(symbol_indices)):
+        s = symbol_indices[i]
+        value = codes[s]
+        nb = code_lengths[s]
+        while 0 < nb:
+            shift = bit_pos & 7
+            take = min(8 - shift, nb)
+            byte_array[bit_pos >> 3] |= (value & ((1 << take) - 1)) << shift
+            value = value >> take
+            nb -= take
+            bit_pos += take
+    return bit_pos
+
+def _huffman_tree_walk_kernel(byte_array, bit_count, child0, child1, keys, decoded_values):
+    num_values = 0
+    node = 0
+    for i in range(bit_count):
+        bit = (byte_array[i >> 3] >> (i & 7)) & 1
+        if bit == 0:
+            node = child0[node]
+        else:
+            node = child1[node]
+        if node < 0:
+            raise ValueError("invalid huffman code")
+        if 0 <= keys[node]:
+            decoded_values[num_values] = keys[node]
+            num_values += 1
+            node = 0
+    return num_values
+
+def _min_code_length(child0, child1, keys):
+    # 根から幅優先で辿り、最初に葉が現れた深さを返す
+    depth = 0
+    nodes = [0]
+    while nodes:
+        depth += 1
+        nodes = [int(child) for node in nodes for child in (child0[node], child1[node]) if 0 <= child]
+        if any(0 <= keys[node] for node in nodes):
+            return depth
+    return 1
+
+def _fse_encode(symbol_indices, delta_nb_bits, delta_find_state, state_table,
+                states, byte_array):
+    # 末尾の記号から符号化し、ビット列は前方へ書き出す(復号側は後方から読む)
+    # 記号 i は状態 i % num_states が担当する。states は 2**table_log で初期化して渡す
+    num_states = len(states)
+    bit_pos = 0
+    for i in range(len(symbol_indices) - 1, -1, -1):
+        k = i % num_states
+        s = symbol_indices[i]
+        state = states[k]
+        nb = (state + delta_nb_bits[s]) >> 16
+        value = state & ((1 << nb) - 1)
+        next_state = state_table[(state >> nb) + delta_find_state[s]]
+        while 0 < nb:
+            shift = bit_pos & 7
+            take = min(8 - shift, nb)
+            byte_array[bit_pos >> 3] |= (value & ((1 << take) - 1)) << shift
+            value = value >> take
+            nb -= take
+            bit_pos += take
+        states[k] = next_state
+    return bit_pos
+
+def _fse_decode(byte_array, bit_count, states,
+                symbol_table, nb_bits_table, base_table, decoded_values):
+    num_values = len(decoded_values)
+    num_states = len(states)
+    bit_pos = bit_count
+    for i in range(num_values):
+        k = i % num_states
+        state = states[k]
+        decoded_values[i] = symbol_table[state]
+        nb = nb_bits_table[state]
+        bit_pos -= nb
+        value = 0
+        read_pos = bit_pos
+        got = 0
+        while got < nb:
+            shift = read_pos & 7
+            take = min(8 - shift, nb - got)
+            value |= ((int(byte_array[read_pos >> 3]) >> shift) & ((1 << take) - 1)) << got
+            got += take
+            read_pos += take
+        states[k] = base_table[state] + value
+    return decoded_values
+
+class _PythonBackend:
+    name = "python"
+
+    def __init__(self):
+        self.reverse_bit_order = _reverse_bit_order
+        self.read_bits = _read_bits
+        self.write_bits = _write_bits
+        self.decode_symbol = _decode_symbol
+        self.huffman_tree_walk = _huffman_tree_walk
+        self.huffman_multi_tree_walk = _huffman_multi_tree_walk
+        self.inflate_block = _make_inflate_block(_read_bits, _decode_symbol)
+        self.huffman_encode = _huffman_encode
+        self.fse_encode = _fse_encode
+        self.fse_decode = _fse_decode
+
+    def byte_array(self, data):
+        return data
+
+    def index_array(self, values):
+        if hasattr(values, "tolist"):
+            return values.tolist()
+        return list(values)
+
+class _NumbaBackend:
+    name = "numba"
+
+    def __init__(self):
+        import numba
+        njit = numba.njit(cache=True, nogil=True)
+        self.reverse_bit_order = njit(_reverse_bit_order)
+        self.read_bits = njit(_read_bits)
+        self.write_bits = njit(_write_bits)
+        self.decode_symbol = njit(_decode_symbol)
+        self.__huffman_tree_walk = njit(_huffman_tree_walk_kernel)
+        self.huffman_multi_tree_walk = njit(_huffman_multi_tree_walk)
+        self.inflate_block = njit(_make_inflate_block(self.read_bits, self.decode_symbol))
+        self.huffman_encode = njit(_huffman_encode)
+        self.fse_encode = njit(_fse_encode)
+        self.fse_decode = njit(_fse_decode)
+
+    def byte_array(self, data):
+        import numpy
+        if isinstance(data, numpy.ndarray):
+            return data.astype(numpy.uint8, copy=False)
+        try:
+            # bytes や mmap などバッファを持つものはコピーせずに参照する
+            return numpy.frombuffer(data, dtype=numpy.uint8)
+        except TypeError:
+            return numpy.asarray(data, dtype=numpy.uint8)
+
+    def index_array(self, values):
+        import numpy
+        return numpy.asarray(values, dtype=numpy.int64)
+
+    def huffman_tree_walk(self, byte_array, bit_count, child0, child1, keys):
+        import numpy
+        # 記号数は最短の符号長で割った数を超えないので、1ビットごとに枠を取らずに済む
+        decoded_values = numpy.empty(
+            int(bit_count) // _min_code_length(child0, child1, keys) + 1, dtype=numpy.int64)
+        num_values = self.__huffman_tree_walk(
+            self.byte_array(byte_array), int(bit_count),
+            self.index_array(child0), self.index_array(child1), self.index_array(keys),
+            decoded_values)
+        return decoded_values[:num_values]
+
+def available_backends():
+    backends = ["python"]
+    # numba 自体の import は重いので、ここでは有無だけを調べる
+    if importlib.util.find_spec("numba") is not None:
+        backends.insert(0, "numba")
+    return backends
+
+def __make_backend(name):
+    if name == "auto":
+        name = available_backends()[0]
+    if name == "numba":
+        return _NumbaBackend()
+    elif name == "python":
+        return _PythonBackend()
+    raise ValueError("unknown kernel backend: {}".format(name))
+
+_backend = None
+
+def set_backend(name):
+    global _backend
+    global backend, reverse_bit_order, read_bits, write_bits
+    global decode_symbol, huffman_tree_walk, inflate_block, huffman_encode
+    global huffman_multi_tree_walk, fse_encode, fse_decode
+    global byte_array, index_array
+    _backend = __make_backend(name)
+    backend = _backend.name
+    reverse_bit_order = _backend.reverse_bit_order
+    read_bits = _backend.read_bits
+    write_bits = _backend.write_bits
+    decode_symbol = _backend.decode_symbol
+    huffman_tree_walk = _backend.huffman_tree_walk
+    huffman_multi_tree_walk = _backend.huffman_multi_tree_walk
+    inflate_block = _backend.inflate_block
+    huffman_encode = _backend.huffman_encode
+    fse_encode = _backend.fse_encode
+    fse_decode = _backend.fse_decode
+    byte_array = _backend.byte_array
+    index_array = _backend.index_array
+    return backend
+
+__BACKEND_ATTRIBUTES = {
+    "backend", "reverse_bit_order", "read_bits", "write_bits",
+    "decode_symbol", "huffman_tree_walk", "huffman_multi_tree_walk",
+    "inflate_block", "huffman_encode", "fse_encode", "fse_decode",
+    "byte_array", "index_array"}
+
+def __getattr__(name):
+    # 最初に参照されたときに環境変数に従ってバックエンドを決める(PEP 562)
+    # set_backend 後はモジュール変数になるので、以降はここを通らない
+    if name in __BACKEND_ATTRIBUTES:
+        set_backend(os.environ.get(BACKEND_ENV, "auto").lower())
+        return globals()[name]
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+if __name__ == "__main__":
+    import unittest
+    import zlib
+    import random
+    import numpy
+
+    # python -m で実行すると __main__ とは別に codeckit.kernels が読み込まれるので、
+    # 各コーデックが参照している方のバックエンドを切り替える
+    from . import kernels as package_kernels
+
+    def _run_on_each_backend(func):
+        results = {}
+        current = package_kernels.backend
+        try:
+            for name in available_backends():
+                package_kernels.set_backend(name)
+                results[name] = func()
+        finally:
+            package_kernels.set_backend(current)
+        return results
+
+    class TestKernelBackends(unittest.TestCase):
+        def setUp(self):
+            rand = random.Random(0)
+            with open(__file__, "rb") as text_file:
+                text = text_file.read()
+            self.samples = [
+                b"abcdefg",
+                bytes(1000) + b"\x01",
+                bytes(rand.getrandbits(8) for _ in range(3000)),
+                text,
+                text * 3 + bytes(rand.getrandbits(2) for _ in range(5000)),
+            ]
+
+        def assertIdentical(self, results):
+            values = list(results.values())
+            for v in values[1:]:
+                self.assertEqual(values[0], v)
+
+        def test_bitstream_roundtrip(self):
+            from .bitstreamer import BitWriter, BitReader
+            rand = random.Random(1)
+            fields = [(rand.getrandbits(w), w) for w in
+                        [rand.randint(1, 40) for _ in range(2000)]]
+            total_bytes = (sum(w for _, w in fields) + 7) // 8
+            def run():
+                writer = BitWriter(total_bytes)
+                for value, bits in fields:
+                    writer.write(value, bits)
+                byte_array, last_bits = writer.get()
+                reader = BitReader(byte_array)
+                read_values = [reader.read(bits) for _, bits in fields]
+                self.assertEqual(read_values, [v for v, _ in fields])
+                return byte_array.tobytes(), last_bits
+            self.assertIdentical(_run_on_each_backend(run))
+
+        def test_reverse_bit_order(self):
+            cases = [(0b1011, 2, 0b11), (5, 0, 0), (0b1101, 4, 0b1011), (1, 15, 1 << 14), (0x1ff, 8, 0xff)]
+            def run():
+                return [int(package_kernels.reverse_bit_order(value, bits)) for value, bits, _ in cases]
+            results = _run_on_each_backend(run)
+            self.assertIdentical(results)
+            self.assertEqual(results["python"], [expected for _, _, expected in cases])
+
+        def test_huffman(self):
+            from . import huffman
+            for data in self.samples:
+                def run():
+                    encoded = huffman.encode(data)
+                    decoded = huffman.decode(encoded)
+                    self.assertEqual(bytes(decoded), data)
+                    return encoded
+                self.assertIdentical(_run_on_each_backend(run))
+            def run_negative():
+                with self.assertRaisesRegex(ValueError, "non-negative"):
+                    huffman.encode(numpy.array([-1, 2, -1, 3]))
+            _run_on_each_backend(run_negative)
+
+        def test_huffman_multi_table(self):
+            from . import huffman
+            for data in self.samples:
+                def run():
+                    encoded = huffman.encode_multi_table(data, segment_size=256)
+                    decoded = huffman.decode(encoded)
+                    self.assertEqual(bytes(decoded), data)
+                    return encoded
+                self.assertIdentical(_run_on_each_backend(run))
+
+        def test_fse(self):
+            from . import fse
+            for data in self.samples:
+                def run():
+                    encoded = fse.encode(data)
+                    decoded = fse.decode(encoded)
+                    self.assertEqual(bytes(decoded), data)
+                    return encoded
+                self.assertIdentical(_run_on_each_backend(run))
+
+        def test_deflate(self):
+            from . import deflate
+            decode = getattr(deflate, "__decode")
+            for data in self.samples:
+                for level in [0, 1, 6, 9]:
+                    deflated = zlib.compress(data, level)[2:-4]
+                    def run():
+                        decoded = decode(deflated)
+                        self.assertEqual(bytes(decoded), data)
+                        return bytes(decoded)
+                    self.assertIdentical(_run_on_each_backend(run))
+
+    unittest.main()
+    exit()